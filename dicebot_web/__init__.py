@@ -16,9 +16,15 @@ from flask import (
     url_for,
 )
 from sqlalchemy.orm.exc import NoResultFound
+from werkzeug.exceptions import HTTPException
 
-from .util import AUTHORIZATION_BASE_URL, TOKEN_URL, get_user, make_session
+from .util import AUTHORIZATION_BASE_URL, TOKEN_URL, cached_user, get_user, make_session
 from .database import db, m
+from .blacklist import blacklist
+from .cache import discord_cache
+from .coalesce import coalescer
+from .compress import compress
+from .warmer import warmer
 from .restful import api_bp
 from .help import help_bp
 
@@ -28,8 +34,17 @@ app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = None
+# most Discord calls a request makes at once under gevent
+app.config['DISCORD_CONCURRENCY'] = 8
+# log Discord calls avoided by the per-request memo
+app.config['DISCORD_MEMO_DEBUG'] = False
 # Attach Database and REST
 db.init_app(app)
+discord_cache.init_app(app)
+compress.init_app(app)
+coalescer.init_app(app)
+blacklist.init_app(app)
+warmer.init_app(app)
 app.register_blueprint(api_bp, url_prefix='/api')
 app.register_blueprint(help_bp, url_prefix='/help')
 
@@ -95,11 +110,15 @@ def create_app():
             app.config['PERMANENT_SESSION_LIFETIME'] = \
                 datetime.timedelta(int(app.config['PERMANENT_SESSION_LIFETIME']))
             app.secret_key = app.config['token']
+            # needs discord_client_id for the invite link
+            prerender_error_pages()
+            blacklist.refresh()
 
 
 @app.before_request
 def make_session_permanent():
     session.permanent = True
+    warmer.touch_request()
 
 
 @app.context_processor
@@ -128,20 +147,44 @@ def context():
 # ----#-   Errors
 
 
+# anonymous error pages by (title, message)
+error_pages = {}
+
+
 def error(e, message=None):
     '''
     Basic error template for all error pages
+    Only uses the cached identity so errors never wait on Discord
     '''
-    user, discord = get_user(session.get('oauth2_token'))
+    user = cached_user(session.get('oauth2_token'))
+    # flashed messages are part of the page, so it can't be reused
+    anonymous = user is None and not session.get('_flashes')
+    key = (str(e), message)
+    if anonymous and key in error_pages:
+        return error_pages[key]
     html = render_template(
         'error.html',
         user=user,
         title=str(e),
         message=message,
     )
+    if anonymous:
+        error_pages[key] = html
     return html
 
 
+def prerender_error_pages():
+    '''
+    Renders the anonymous error pages ahead of time
+    '''
+    with app.test_request_context():
+        for code in (400, 403, 404, 500):
+            try:
+                abort(code)
+            except HTTPException as e:
+                app.handle_user_exception(e)
+
+
 @app.errorhandler(400)
 def four_hundred(e):
     '''
@@ -263,9 +306,9 @@ def callback():
         client_secret=app.config['discord_client_secret'],
         authorization_response=request.url)
     user, discord = get_user(token=token)
-    blacklisted = db.session.query(m.Blacklist).get(int(user['id']))
-    if not blacklisted:
+    if user['id'] not in blacklist:
         session['oauth2_token'] = token
+        session['user_id'] = user['id']
         return redirect(url_for('index'))
     else:
         abort(403)
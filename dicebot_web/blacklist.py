@@ -0,0 +1,102 @@
+import time
+import threading
+
+from flask import abort, session
+
+from .database import db, m
+from .util import get_user
+
+
+class BlacklistIndex:
+    '''
+    In-memory set of blacklisted user IDs checked on every request
+
+    The set is reloaded from the database every BLACKLIST_REFRESH seconds
+    by whichever request first notices it is stale
+    Lookups never touch the database
+    Refresh counts and timings are logged every BLACKLIST_STATS_INTERVAL refreshes
+    '''
+    def __init__(self, app=None):
+        self.ids = frozenset()
+        self.loaded = None
+        self.lock = threading.Lock()
+        # refresh metrics
+        self.refreshes = 0
+        self.failures = 0
+        self.last_refresh_seconds = 0.0
+        self.total_refresh_seconds = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLACKLIST_REFRESH', 30)
+        app.config.setdefault('BLACKLIST_STATS_INTERVAL', 10)
+        self.app = app
+        app.before_request(self.before_request)
+
+    def __contains__(self, user_id):
+        return str(user_id) in self.ids
+
+    def stale(self):
+        return self.loaded is None or time.time() - self.loaded > self.app.config['BLACKLIST_REFRESH']
+
+    def refresh(self):
+        '''
+        Reloads the blacklist from the database
+        Only one refresh runs at a time, other callers keep using the current set
+        '''
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            start = time.perf_counter()
+            key, = m.Blacklist.__mapper__.primary_key
+            ids = frozenset(str(id) for id, in db.session.query(key))
+            # don't hold a pooled connection for the rest of the request
+            db.session.commit()
+            added, removed = ids - self.ids, self.ids - ids
+            self.ids = ids
+            self.loaded = time.time()
+            self.last_refresh_seconds = time.perf_counter() - start
+            self.total_refresh_seconds += self.last_refresh_seconds
+            self.refreshes += 1
+            if added or removed:
+                self.app.logger.info('Blacklist updated: %d added, %d removed', len(added), len(removed))
+            self.app.logger.debug(
+                'Blacklist refreshed with %d entries in %.4fs', len(ids), self.last_refresh_seconds)
+            if self.refreshes % self.app.config['BLACKLIST_STATS_INTERVAL'] == 0:
+                self.app.logger.info('Blacklist stats: %s', self.stats())
+        except Exception:
+            # keep enforcing the previous set until the next interval
+            db.session.rollback()
+            self.loaded = time.time()
+            self.failures += 1
+            self.app.logger.exception('Failed to refresh blacklist')
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {
+            'entries': len(self.ids),
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'last_refresh_seconds': self.last_refresh_seconds,
+            'total_refresh_seconds': self.total_refresh_seconds,
+        }
+
+    def before_request(self):
+        if self.stale():
+            self.refresh()
+        if 'oauth2_token' not in session:
+            return
+        if 'user_id' not in session:
+            # sessions from before user_id was stored
+            user, discord = get_user(session['oauth2_token'])
+            if user is None:
+                return
+            session['user_id'] = user['id']
+        if session['user_id'] in self:
+            session.clear()
+            abort(403)
+
+
+blacklist = BlacklistIndex()
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class Cache:
+    '''
+    Interface for the Discord data caches
+    Values must be JSON serializable, each get returns a fresh copy
+    '''
+    def get(self, key):
+        '''
+        Returns the value stored for key or None if missing or expired
+        '''
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        '''
+        Stores value under key for ttl seconds
+        '''
+        raise NotImplementedError
+
+    def expires(self, key):
+        '''
+        Returns the time the entry for key expires, or None if there is no entry
+        '''
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache (Cache):
+    '''
+    In-process least recently used cache
+    '''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        value = json.dumps(value)
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def expires(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        return None if entry is None else entry[0]
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SQLiteCache (Cache):
+    '''
+    Cache stored in a SQLite file so it is shared by every worker process on the host
+    Each write is a single transaction, so readers never see partial updates
+
+    sqlite3 calls block the whole gevent worker, so the database is only waited on briefly
+    A locked database is treated as a miss on reads and skipped on writes
+    '''
+    # prune expired and excess entries once every this many writes
+    prune_interval = 100
+    # seconds to wait for a lock held by another worker
+    busy_timeout = 0.05
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.pid = None
+        self.connection = None
+
+    def connect(self):
+        # connections can't be shared with a forked child
+        if self.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            try:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS cache '
+                    '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+            except Exception:
+                # retried on the next call
+                connection.close()
+                raise
+            self.connection = connection
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, key):
+        try:
+            with self.lock:
+                row = self.connect().execute(
+                    'SELECT value FROM cache WHERE key = ? AND expires >= ?', (key, time.time())).fetchone()
+        except sqlite3.OperationalError:
+            # locked by another worker
+            return None
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        value = json.dumps(value)
+        try:
+            with self.lock:
+                connection = self.connect()
+                connection.execute(
+                    'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                    (key, value, time.time() + ttl))
+                self.writes += 1
+                if self.writes % self.prune_interval == 0:
+                    self.prune(connection)
+        except sqlite3.OperationalError:
+            # locked by another worker, the next fetch will store it
+            pass
+
+    def expires(self, key):
+        try:
+            with self.lock:
+                row = self.connect().execute('SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return None if row is None else row[0]
+
+    def prune(self, connection):
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+            connection.execute(
+                'DELETE FROM cache WHERE key IN '
+                '(SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def delete(self, key):
+        try:
+            with self.lock:
+                self.connect().execute('DELETE FROM cache WHERE key = ?', (key,))
+        except sqlite3.OperationalError:
+            # the entry still expires after its ttl
+            pass
+
+    def clear(self):
+        try:
+            with self.lock:
+                self.connect().execute('DELETE FROM cache')
+        except sqlite3.OperationalError:
+            # entries still expire after their ttl
+            pass
+
+
+class DiscordCache:
+    '''
+    Holds the cache backend for data fetched from Discord
+
+    DISCORD_CACHE is the path of a SQLite file shared between workers,
+    when it is not set an in-process LRU cache is used
+    '''
+    def __init__(self, app=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DISCORD_CACHE', os.environ.get('DISCORD_CACHE'))
+        app.config.setdefault('DISCORD_CACHE_SIZE', 10000)
+        # seconds that fetched data is considered fresh
+        app.config.setdefault('DISCORD_CACHE_TTL', 60)
+        if app.config['DISCORD_CACHE']:
+            self.backend = SQLiteCache(app.config['DISCORD_CACHE'], app.config['DISCORD_CACHE_SIZE'])
+        else:
+            self.backend = MemoryCache(app.config['DISCORD_CACHE_SIZE'])
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, ttl):
+        self.backend.set(key, value, ttl)
+
+    def expires(self, key):
+        return self.backend.expires(key)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+
+discord_cache = DiscordCache()
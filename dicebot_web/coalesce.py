@@ -0,0 +1,129 @@
+import atexit
+import threading
+
+from .database import db
+
+
+class WriteCoalescer:
+    '''
+    Merges bursts of increments to the same row
+
+    Increments are held for COALESCE_WINDOW seconds after the first one arrives,
+    then each row is written with a single UPDATE of column + delta,
+    so increments never conflict with each other, whichever worker applies them
+    Sets are written straight through, replacing any increments queued before them
+
+    Pending increments are only held by the worker that received them,
+    so flushing before a read only guarantees read-after-write on the same worker
+    Another worker may see the value up to COALESCE_WINDOW seconds late,
+    and an increment queued there may land after a set made here
+    '''
+    def __init__(self, app=None):
+        # (type, character_id, item_id) -> {field: delta}
+        self.pending = {}
+        self.lock = threading.Lock()
+        # keeps writes for the same row from being committed out of order
+        self.flush_lock = threading.Lock()
+        self.timer = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COALESCE_WINDOW', 0.25)
+        self.app = app
+        # don't drop accepted increments when the process exits
+        atexit.register(self.flush_all)
+
+    def is_pending(self, type, character_id, item_id):
+        with self.lock:
+            return (type, character_id, item_id) in self.pending
+
+    def matching(self, type=None, character_id=None):
+        # must be called with self.lock held
+        return [
+            key for key in self.pending
+            if (type is None or key[0] is type) and (character_id is None or key[1] == character_id)
+        ]
+
+    def increment(self, type, character_id, item_id, field, delta):
+        '''
+        Queues an increment and returns the total increment now pending for the field
+        '''
+        key = (type, character_id, item_id)
+        with self.lock:
+            fields = self.pending.setdefault(key, {})
+            fields[field] = fields.get(field, 0) + delta
+            if self.timer is None:
+                self.timer = threading.Timer(self.app.config['COALESCE_WINDOW'], self.flush_all)
+                self.timer.daemon = True
+                self.timer.start()
+            return fields[field]
+
+    def set(self, type, character_id, item_id, field, value):
+        '''
+        Writes a value immediately, discarding increments to the field queued before it
+        '''
+        key = (type, character_id, item_id)
+        with self.flush_lock:
+            with self.lock:
+                fields = self.pending.get(key, {})
+                fields.pop(field, None)
+                if not fields:
+                    self.pending.pop(key, None)
+            self.execute([(key, {field: value})])
+
+    def take(self, type=None, character_id=None):
+        with self.lock:
+            keys = self.matching(type, character_id)
+            return [(key, {
+                field: key[0].__table__.c[field] + delta
+                for field, delta in self.pending.pop(key).items()
+            }) for key in keys]
+
+    def execute(self, batch):
+        '''
+        Writes a list of (key, {field: value or expression}) in one transaction
+        '''
+        try:
+            for (type, character_id, item_id), values in batch:
+                table = type.__table__
+                db.session.execute(
+                    table.update()
+                    .where(table.c.id == item_id)
+                    .where(table.c.character_id == character_id)
+                    .values(values))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def flush(self, type=None, character_id=None):
+        '''
+        Writes pending increments immediately
+        Limited to the given type and character when they are provided
+        '''
+        # most reads have nothing pending, so don't wait behind other writes for them
+        # unless a flush that may have taken this character's increments is still committing
+        with self.lock:
+            if not self.matching(type, character_id) and not self.flush_lock.locked():
+                return
+        with self.flush_lock:
+            batch = self.take(type, character_id)
+            if batch:
+                self.execute(batch)
+
+    def flush_all(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Failed to write coalesced updates')
+
+
+coalescer = WriteCoalescer()
@@ -0,0 +1,136 @@
+import zlib
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# static files are sent with direct_passthrough and are left to the web server
+COMPRESSIBLE_TYPES = {
+    'application/json',
+    'application/x-ndjson',
+    'text/html',
+    'text/plain',
+}
+
+
+def gzip_compressor(level):
+    # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class BrotliCompressor:
+    '''
+    Wraps a brotli compressor to match the zlib compressobj interface
+    '''
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+class Compress:
+    '''
+    Compresses responses with gzip or brotli based on the Accept-Encoding header
+
+    Responses smaller than COMPRESS_MIN_SIZE are sent as is
+    Streamed responses are compressed chunk by chunk
+    Compressed bodies of responses with an ETag are cached by (etag, encoding)
+    '''
+    def __init__(self, app=None):
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+        app.config.setdefault('COMPRESS_BROTLI_LEVEL', 4)
+        app.config.setdefault('COMPRESS_CACHE_SIZE', 256)
+        self.app = app
+        app.after_request(self.after_request)
+
+    def choose_encoding(self):
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br'] and accepted['br'] >= accepted['gzip']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def compressor(self, encoding):
+        if encoding == 'br':
+            return BrotliCompressor(self.app.config['COMPRESS_BROTLI_LEVEL'])
+        return gzip_compressor(self.app.config['COMPRESS_GZIP_LEVEL'])
+
+    def compress(self, encoding, data):
+        compressor = self.compressor(encoding)
+        return compressor.compress(data) + compressor.flush()
+
+    def stream(self, encoding, chunks):
+        compressor = self.compressor(encoding)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def cached(self, etag, encoding, data):
+        key = (etag, encoding)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        compressed = self.compress(encoding, data)
+        with self.lock:
+            self.cache[key] = compressed
+            while len(self.cache) > self.app.config['COMPRESS_CACHE_SIZE']:
+                self.cache.popitem(last=False)
+        return compressed
+
+    def after_request(self, response):
+        if response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return response
+        if 'Content-Encoding' in response.headers or response.direct_passthrough:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self.stream(encoding, response.response)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.app.config['COMPRESS_MIN_SIZE']:
+                return response
+            etag, _ = response.get_etag()
+            if etag is not None:
+                compressed = self.cached(etag, encoding, data)
+                # the encoded bytes differ but the content is equivalent
+                response.set_etag(etag, weak=True)
+            else:
+                compressed = self.compress(encoding, data)
+            response.set_data(compressed)
+            self.app.logger.debug(
+                'compressed %s from %d to %d bytes with %s',
+                request.path, len(data), len(compressed), encoding)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+compress = Compress()
@@ -2,19 +2,38 @@ import os
 import enum
 import json
 from operator import itemgetter
+from functools import partial
 from collections import OrderedDict
 
-from flask import Blueprint, current_app, session
+from flask import Blueprint, Response, current_app, request, session, stream_with_context
 from flask_restful import Api, Resource, reqparse, abort
 from sqlalchemy import asc, nullsfirst
 from sqlalchemy.exc import IntegrityError
 
 from . import util
+from .coalesce import coalescer
 from .database import db, m
 
 api_bp = Blueprint('api', __name__)
 api = Api(api_bp)
 
+# child tables of a character, filled in by add_character_resource
+# maps the collection name to a (type, fields) tuple
+character_resources = OrderedDict()
+
+
+@api_bp.after_request
+def add_etag(response):
+    '''
+    Adds an ETag to JSON GET responses so clients can revalidate
+    and compressed bodies can be cached
+    '''
+    if request.method == 'GET' and response.status_code == 200 \
+            and response.mimetype == 'application/json' and not response.is_streamed:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
 
 def entry2json(entry):
     entry = entry.dict()
@@ -44,21 +63,36 @@ def prep_cast(cast):
 
 
 def get_user(user_id, server_id=None):
+    '''
+    Gets a user, or a member with their admin status when server_id is given
+    The result is reused for the rest of the request
+    '''
     user_id = str(user_id)
+    server_id = None if server_id is None else str(server_id)
+    return util.request_memo(('member', server_id, user_id), lambda: lookup_user(user_id, server_id))
+
+
+def lookup_user(user_id, server_id=None):
     if server_id is None:
-        resp = util.bot_get(util.API_BASE_URL + '/users/' + user_id)
+        resp = util.cached_bot_get('/users/' + user_id)
         if not resp:
             abort(resp.status_code)
         user = resp.json()
     else:
-        resp = util.user_in_guild(server_id, user_id)
+        resp, (status, guild) = util.concurrently(
+            lambda: util.user_in_guild(server_id, user_id),
+            lambda: util.cached_guild(server_id),
+        )
         if not resp and resp.status_code == 404:
             return get_user(user_id)
         elif not resp:
             abort(resp.status_code)
-        member = resp.json()
-        member['admin'] = util.user_is_admin(server_id, member)
-        user = member.pop('user')
+        if guild is None:
+            abort(status)
+        # the response may be shared with other calls in this request
+        member = dict(resp.json())
+        member['admin'] = util.user_is_admin(guild, member)
+        user = dict(member.pop('user'))
         user.update(member)
     return user
 
@@ -77,18 +111,21 @@ def get_character(character_id, secure=True):
     character = db.session.query(m.Character).get(character_id)
     if not character:
         abort(403)
+    character = character2json(user, character)
+    # return the database connection to the pool while waiting on Discord
+    db.session.commit()
 
-    member = get_user(user['id'], server_id=character.server)  # ensures that user is in the same guild
+    member = get_user(user['id'], server_id=character['server'])  # ensures that user is in the same guild
 
     if secure:
         # ensure that the user owns the character or is a DM and DM character
-        if not character.user == user['id'] and not (character.user == 'DM' and member['admin']):
+        if not character['user'] == user['id'] and not (character['user'] == 'DM' and member['admin']):
             abort(403)
 
-    if character.user == 'DM' and not member['admin']:
+    if character['user'] == 'DM' and not member['admin']:
         abort(403)
 
-    return character2json(user, character)
+    return character
 
 
 @api.resource('/user/<int:user_id>')
@@ -122,25 +159,46 @@ class MyServers (Resource):
         user, discord = util.get_user(session.get('oauth2_token'))
         if user is None:
             abort(401)
-        guilds = util.user_get(discord, util.API_BASE_URL + '/users/@me/guilds').json()
-        guilds = filter(util.bot_in_guild, guilds)
+        guilds = util.get_user_guilds(discord)
+        present = util.concurrently(*(partial(util.bot_in_guild, guild) for guild in guilds))
+        guilds = (guild for guild, bot in zip(guilds, present) if bot)
         guilds = sorted(guilds, key=itemgetter('name'))
-        return list(guilds)
+        return guilds
 
 
 @api.resource('/server/<int:server_id>')
 class Server (Resource):
+    '''
+    Returns the id, name, icon, owner_id and admin_roles of a server
+    The full discord guild object is returned when full is true
+    '''
     def get(self, server_id):
+        parser = reqparse.RequestParser()
+        parser.add_argument('full', type=prep_cast(bool), default=False, help='Return the full guild object')
+        args = parser.parse_args()
         server_id = str(server_id)
         user, discord = util.get_user(session.get('oauth2_token'))
         if user is None:
             abort(401)
-        if not util.user_in_guild(server_id, user['id']):
+        if args['full']:
+            member, server = util.concurrently(
+                lambda: util.user_in_guild(server_id, user['id']),
+                lambda: util.bot_get(util.API_BASE_URL + '/guilds/' + server_id),
+            )
+        else:
+            member, (status, server) = util.concurrently(
+                lambda: util.user_in_guild(server_id, user['id']),
+                lambda: util.cached_guild(server_id),
+            )
+        if not member:
             abort(403)
-        server = util.bot_get(util.API_BASE_URL + '/guilds/' + server_id)
-        if not server:
-            abort(server.status_code)
-        return server.json()
+        if args['full']:
+            if not server:
+                abort(server.status_code)
+            return server.json()
+        if server is None:
+            abort(status)
+        return server._asdict()
 
 
 @api.resource('/server/<int:server_id>/characters')
@@ -210,12 +268,17 @@ class Characters (Resource):
         user, discord = util.get_user(session.get('oauth2_token'))
         if user is None:
             abort(401)
+        server_id = db.session.query(m.Character.server).filter_by(id=character_id).scalar()
+        if server_id is None:
+            abort(403)
+        # return the database connection to the pool while waiting on Discord
+        db.session.commit()
+
+        member = get_user(user['id'], server_id=server_id)
         character = db.session.query(m.Character).get(character_id)
         if not character:
             abort(403)
 
-        member = get_user(user['id'], server_id=character.server)
-
         # change name
         if 'name' in args:
             if not args['name']:
@@ -262,12 +325,15 @@ class Characters (Resource):
 
 
 class CharacterResource (Resource):
-    def __init__(self, type, fields):
+    def __init__(self, type, fields, counters):
         self.type = type
         self.fields = fields
+        self.counters = counters
 
     def get(self, character_id, item_id):
         character = get_character(character_id, secure=False)
+        if self.counters:
+            coalescer.flush(self.type, character['id'])
         data = db.session.query(self.type)\
             .filter_by(character_id=character['id'], id=item_id).one_or_none()
         if not data:
@@ -281,6 +347,8 @@ class CharacterResource (Resource):
                 parser.add_argument(field, type=prep_cast(cast), store_missing=False)
         args = parser.parse_args()
         character = get_character(character_id, secure=True)
+        if self.counters:
+            coalescer.flush(self.type, character['id'])
         item = db.session.query(self.type)\
             .filter_by(character_id=character['id'], id=item_id).one_or_none()
         if item is None:
@@ -301,6 +369,8 @@ class CharacterResource (Resource):
 
     def delete(self, character_id, item_id):
         character = get_character(character_id, secure=True)
+        if self.counters:
+            coalescer.flush(self.type, character['id'])
         item = db.session.query(self.type)\
             .filter_by(character_id=character['id'], id=item_id).one_or_none()
         if item is not None:
@@ -310,13 +380,16 @@ class CharacterResource (Resource):
 
 
 class CharacterResourceList (Resource):
-    def __init__(self, type, order, fields):
+    def __init__(self, type, order, fields, counters):
         self.type = type
         self.order = order
         self.fields = fields
+        self.counters = counters
 
     def get(self, character_id):
         character = get_character(character_id, secure=False)
+        if self.counters:
+            coalescer.flush(self.type, character['id'])
         data = db.session.query(self.type)\
             .filter_by(character_id=character['id'])
         if isinstance(self.order, str):
@@ -348,17 +421,65 @@ class CharacterResourceList (Resource):
             return entry2json(item)
 
 
-def add_character_resource(api, short_name, name, type, order, fields):
+class CharacterResourceCounter (Resource):
+    '''
+    Increments or sets a numeric field of a character resource
+    Rapid increments to the same item are merged and written together,
+    sets are written immediately
+    Only reads served by the same worker are guaranteed to see queued increments
+    '''
+    def __init__(self, type, counters):
+        self.type = type
+        self.counters = counters
+
+    def post(self, character_id, item_id):
+        parser = reqparse.RequestParser()
+        parser.add_argument('field', required=True, choices=self.counters, help='Field to change')
+        parser.add_argument('op', default='increment', choices=('increment', 'set'), help='How to apply the value')
+        parser.add_argument('value', type=int, required=True, help='Amount to add or value to set')
+        parser.add_argument('flush', type=prep_cast(bool), default=False, help='Write immediately and return the item')
+        args = parser.parse_args()
+        character = get_character(character_id, secure=True)
+        # the UPDATE would silently match nothing, so check the item once when it is first queued
+        if not coalescer.is_pending(self.type, character['id'], item_id):
+            exists = db.session.query(self.type.id)\
+                .filter_by(character_id=character['id'], id=item_id).first()
+            if exists is None:
+                abort(404)
+        if args['op'] == 'set':
+            coalescer.set(self.type, character['id'], item_id, args['field'], args['value'])
+        else:
+            delta = coalescer.increment(self.type, character['id'], item_id, args['field'], args['value'])
+            if not args['flush']:
+                return {'field': args['field'], 'op': 'increment', 'value': delta}, 202
+            coalescer.flush(self.type, character['id'])
+        item = db.session.query(self.type)\
+            .filter_by(character_id=character['id'], id=item_id).one_or_none()
+        if item is None:
+            abort(404)
+        return entry2json(item)
+
+
+def add_character_resource(api, short_name, name, type, order, fields, counters=()):
+    character_resources[name] = (type, fields)
+
+    if counters:
+        api.add_resource(
+            CharacterResourceCounter,
+            '/characters/<int:character_id>/{}/<int:item_id>/adjust'.format(name),
+            resource_class_kwargs={'type': type, 'counters': counters},
+            endpoint=short_name + '-adjust')
+
     api.add_resource(
         CharacterResource,
         '/characters/<int:character_id>/{}/<int:item_id>'.format(name),
-        resource_class_kwargs={'type': type, 'fields': fields},
+        resource_class_kwargs={'type': type, 'fields': fields, 'counters': counters},
         endpoint=short_name)
 
     api.add_resource(
         CharacterResourceList,
         '/characters/<int:character_id>/{}'.format(name),
-        resource_class_kwargs={'type': type, 'order': order, 'fields': fields},
+        resource_class_kwargs={'type': type, 'order': order, 'fields': fields, 'counters': counters},
         endpoint=name)
 
 
@@ -366,19 +487,19 @@ information_fields = {'name': str, 'description': str, 'group': str}
 add_character_resource(api, 'info', 'information', m.Information, (nullsfirst(asc('group')), 'name'), information_fields)
 
 variable_fields = {'name': str, 'value': int}
-add_character_resource(api, 'variable', 'variables', m.Variable, 'name', variable_fields)
+add_character_resource(api, 'variable', 'variables', m.Variable, 'name', variable_fields, counters=('value',))
 
 roll_fields = {'name': str, 'expression': str, 'group': str}
 add_character_resource(api, 'roll', 'rolls', m.Roll, (nullsfirst(asc('group')), 'name'), roll_fields)
 
 resource_fields = {'name': str, 'current': int, 'max': int, 'recover': m.Rest}
-add_character_resource(api, 'resource', 'resources', m.Resource, 'name', resource_fields)
+add_character_resource(api, 'resource', 'resources', m.Resource, 'name', resource_fields, counters=('current',))
 
 spell_fields = {'name': str, 'level': int, 'description': str, 'prepared': bool}
 add_character_resource(api, 'spell', 'spells', m.Spell, ('level', 'name'), spell_fields)
 
 item_fields = {'name': str, 'number': int, 'description': str}
-add_character_resource(api, 'item', 'inventory', m.Item, 'name', item_fields)
+add_character_resource(api, 'item', 'inventory', m.Item, 'name', item_fields, counters=('number',))
 
 
 # ----#-   Extras
@@ -440,3 +561,149 @@ class MakeCharacterTemplate5e (Resource):
 
     def post(self, server_id):
         return make_character(str(server_id), '5e', self.helper)
+
+
+# ----#-   Export/Import
+
+
+def export_characters(server_id, chunk_size):
+    '''
+    Generates one NDJSON line per character on the server
+    Each line contains the character and all of its child rows
+
+    Characters are streamed from the database in chunks of chunk_size
+    and the children for a chunk are loaded with one query per table
+    so memory use does not depend on the size of the server
+    '''
+    def lines(chunk):
+        ids = [character.id for character in chunk]
+        children = {id: {name: [] for name in character_resources} for id in ids}
+        for name, (type, fields) in character_resources.items():
+            rows = db.session.query(type)\
+                .filter(type.character_id.in_(ids))\
+                .order_by(type.id)
+            for row in rows:
+                children[row.character_id][name].append(entry2json(row))
+        for character in chunk:
+            data = entry2json(character)
+            data.update(children[character.id])
+            yield json.dumps(data) + '\n'
+        db.session.expunge_all()
+
+    coalescer.flush()
+    characters = db.session.query(m.Character)\
+        .filter_by(server=server_id)\
+        .order_by(m.Character.id)\
+        .yield_per(chunk_size)
+    chunk = []
+    for character in characters:
+        chunk.append(character)
+        if len(chunk) >= chunk_size:
+            yield from lines(chunk)
+            chunk = []
+    if chunk:
+        yield from lines(chunk)
+
+
+def import_characters(server_id, stream, chunk_size):
+    '''
+    Reads NDJSON lines as produced by export_characters and adds them to the server
+    Characters are flushed in chunks of chunk_size and their children are bulk inserted
+    The caller is responsible for committing or rolling back the transaction
+
+    Returns the number of characters imported
+    '''
+    def flush(chunk):
+        db.session.add_all(character for character, data in chunk)
+        db.session.flush()
+        for name, (type, fields) in character_resources.items():
+            mappings = []
+            for character, data in chunk:
+                for child in data.get(name, []):
+                    mapping = {'character_id': character.id}
+                    for field, cast in fields.items():
+                        if field != 'id' and child.get(field) is not None:
+                            value = child[field]
+                            # exported booleans are JSON booleans, hand edited ones may be strings
+                            if not (cast is bool and isinstance(value, bool)):
+                                value = prep_cast(cast)(value)
+                            mapping[field] = value
+                    mappings.append(mapping)
+            if mappings:
+                db.session.bulk_insert_mappings(type, mappings)
+        db.session.expunge_all()
+
+    count = 0
+    chunk = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        data = json.loads(line.decode('utf-8'))
+        if not isinstance(data, dict) or not data.get('name'):
+            raise ValueError('Each line must be a character object with a name')
+        for name in character_resources:
+            children = data.get(name, [])
+            if not isinstance(children, list) or not all(isinstance(child, dict) for child in children):
+                raise ValueError('{} must be a list of objects'.format(name))
+        character = m.Character(name=data['name'], user=data.get('user'), server=server_id)
+        chunk.append((character, data))
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+        count += len(chunk)
+    return count
+
+
+def get_admin(server_id):
+    '''
+    Ensures that the logged in user is an admin of the given server
+    '''
+    user, discord = util.get_user(session.get('oauth2_token'))
+    if user is None:
+        abort(401)
+    member = get_user(user['id'], server_id=server_id)
+    if not member.get('admin'):  # non-members have no admin key
+        abort(403)
+    return member
+
+
+@api.resource('/server/<int:server_id>/export')
+class ServerExport (Resource):
+    '''
+    Streams every character on a server as NDJSON
+    '''
+    def get(self, server_id):
+        server_id = str(server_id)
+        get_admin(server_id)
+        chunk_size = current_app.config.get('EXPORT_CHUNK_SIZE', 200)
+        return Response(
+            stream_with_context(export_characters(server_id, chunk_size)),
+            mimetype='application/x-ndjson',
+            headers={'Content-Disposition': 'attachment; filename=server-{}.ndjson'.format(server_id)},
+        )
+
+
+@api.resource('/server/<int:server_id>/import')
+class ServerImport (Resource):
+    '''
+    Adds characters to a server from an NDJSON stream
+    The whole import is a single transaction
+    '''
+    def post(self, server_id):
+        server_id = str(server_id)
+        get_admin(server_id)
+        chunk_size = current_app.config.get('EXPORT_CHUNK_SIZE', 200)
+        try:
+            count = import_characters(server_id, request.stream, chunk_size)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            abort(409)
+        except (ValueError, KeyError, TypeError):
+            db.session.rollback()
+            abort(400)
+        return {'message': 'successful', 'imported': count}
@@ -1,16 +1,33 @@
 import os
 import time
+import hashlib
+from collections import namedtuple
 
 import requests
-from flask import current_app, abort, session, url_for
+from flask import current_app, abort, copy_current_request_context, g, has_request_context, request, session, url_for
 from requests_oauthlib import OAuth2Session
 
+from .cache import discord_cache
+
+try:
+    import gevent
+    from gevent import monkey
+    from gevent.pool import Pool
+except ImportError:  # gevent is only needed for the concurrent serving mode
+    gevent = None
+
 # Configure Discord OAuth
 API_BASE_URL = 'https://discordapp.com/api'
 AUTHORIZATION_BASE_URL = API_BASE_URL + '/oauth2/authorize'
 TOKEN_URL = API_BASE_URL + '/oauth2/token'
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = 'true'  # possibly insecure
 
+ADMINISTRATOR = 0x00000008
+
+# the parts of a discord guild that the app uses
+# admin_roles is a tuple of the IDs of roles with the administrator permission
+Guild = namedtuple('Guild', ['id', 'name', 'icon', 'owner_id', 'admin_roles'])
+
 
 def token_updater(token):
     session['oauth_token'] = token
@@ -19,7 +36,10 @@ def token_updater(token):
 def make_session(token=None, state=None, scope=None):
     client_id = current_app.config['discord_client_id']
     client_secret = current_app.config['discord_client_secret']
-    callback = url_for('callback', _external=True, _scheme='http' if current_app.debug else 'https')
+    # background jobs have no request to build the callback from, and don't need it
+    callback = None
+    if has_request_context():
+        callback = url_for('callback', _external=True, _scheme='http' if current_app.debug else 'https')
     return OAuth2Session(
         client_id=client_id,
         token=token,
@@ -35,10 +55,119 @@ def make_session(token=None, state=None, scope=None):
     )
 
 
-def get_user(token=None):
+def concurrently(*calls, limit=None):
+    '''
+    Runs the given functions at the same time and returns their results in order
+    Calls only overlap when running under a gevent worker,
+    otherwise they are run one after another
+    At most limit calls (DISCORD_CONCURRENCY by default) run at once,
+    so large fan-outs don't trip Discord's global rate limit
+    Exceptions (including aborts) from any call are re-raised
+    '''
+    if gevent is None or not monkey.is_module_patched('socket') or len(calls) < 2:
+        return [call() for call in calls]
+    if has_request_context():
+        # green threads get their own g, so share the request's memo explicitly
+        memo = g.setdefault('discord_memo', {})
+
+        def wrap(call):
+            @copy_current_request_context
+            def wrapped():
+                g.discord_memo = memo
+                return call()
+            return wrapped
+        calls = [wrap(call) for call in calls]
+    pool = Pool(limit or current_app.config.get('DISCORD_CONCURRENCY', 8))
+    jobs = [pool.spawn(call) for call in calls]
+    gevent.joinall(jobs, raise_error=True)
+    return [job.value for job in jobs]
+
+
+def request_memo(key, load, refresh=False):
+    '''
+    Returns load() the first time key is used in a request and the same result after that
+    Outside of a request, load is always called
+    With DISCORD_MEMO_DEBUG set, every avoided duplicate is logged
+    '''
+    if not has_request_context():
+        return load()
+    memo = g.setdefault('discord_memo', {})
+    if key in memo and not refresh:
+        if current_app.config.get('DISCORD_MEMO_DEBUG'):
+            current_app.logger.info('Avoided duplicate Discord call for %s in %s', key, request.path)
+        return memo[key]
+    memo[key] = value = load()
+    return value
+
+
+class CachedResponse:
+    '''
+    The parts of a requests Response used by the rest of the app
+    so that responses can be stored in the cache
+    '''
+    __slots__ = ('status_code', 'data')
+
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.data
+
+
+def token_key(token):
+    '''
+    Cache key for data that belongs to the owner of an OAuth token
+    '''
+    return hashlib.sha256(token['access_token'].encode('utf-8')).hexdigest()
+
+
+def get_user(token=None, refresh=False):
     discord = make_session(token=token)
-    user = user_get(discord, API_BASE_URL + '/users/@me').json()
-    return user if 'id' in user else None, discord
+    if not token:
+        return None, discord
+    key = 'user:' + token_key(token)
+
+    def load():
+        user = None if refresh else discord_cache.get(key)
+        if user is None:
+            user = user_get(discord, API_BASE_URL + '/users/@me').json()
+            user = user if 'id' in user else None
+            if user is not None:
+                discord_cache.set(key, user, current_app.config['DISCORD_CACHE_TTL'])
+        return user
+    return request_memo(key, load, refresh), discord
+
+
+def cached_user(token=None):
+    '''
+    Returns the cached identity of the token's owner, or None
+    Never calls Discord
+    '''
+    if not token:
+        return None
+    return discord_cache.get('user:' + token_key(token))
+
+
+def get_user_guilds(discord, refresh=False):
+    '''
+    Gets the guilds of the user that owns the session's token
+    '''
+    key = 'guilds:' + token_key(discord.token)
+
+    def load():
+        guilds = None if refresh else discord_cache.get(key)
+        if guilds is None:
+            resp = user_get(discord, API_BASE_URL + '/users/@me/guilds')
+            if not resp:
+                abort(resp.status_code)
+            guilds = resp.json()
+            discord_cache.set(key, guilds, current_app.config['DISCORD_CACHE_TTL'])
+        return guilds
+    return request_memo(key, load, refresh)
 
 
 def user_get(discord, url):
@@ -67,44 +196,97 @@ def bot_get(url):
     return response
 
 
-def user_in_guild(guild, user):
+def cached_bot_get(path, refresh=False):
+    '''
+    A bot_get of API_BASE_URL + path that is served from the cache when possible
+    Error responses are cached as well, except for server errors
+    '''
+    key = 'bot:' + path
+
+    def load():
+        entry = None if refresh else discord_cache.get(key)
+        if entry is None:
+            response = bot_get(API_BASE_URL + path)
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            entry = [response.status_code, data]
+            if response.status_code < 500:
+                discord_cache.set(key, entry, current_app.config['DISCORD_CACHE_TTL'])
+        return CachedResponse(*entry)
+    return request_memo(key, load, refresh)
+
+
+def user_in_guild(guild, user, refresh=False):
     '''
     Returns whether the given user is in the given guild
     Both guild and user should be the respective IDs
     '''
-    return bot_get(API_BASE_URL + '/guilds/{}/members/{}'.format(guild, user))
+    return cached_bot_get('/guilds/{}/members/{}'.format(guild, user), refresh=refresh)
+
+
+def project_guild(guild):
+    '''
+    Reduces a discord guild object to a Guild
+    '''
+    admin_roles = tuple(
+        role['id'] for role in guild.get('roles', [])
+        if int(role.get('permissions', 0)) & ADMINISTRATOR
+    )
+    return Guild(guild['id'], guild.get('name'), guild.get('icon'), guild.get('owner_id'), admin_roles)
+
+
+def cached_guild(guild, refresh=False):
+    '''
+    Fetches a guild through the cache
+    Returns the status code of the request and the Guild, or None if the request failed
+    '''
+    key = 'guild:{}'.format(guild)
+
+    def load():
+        entry = None if refresh else discord_cache.get(key)
+        if entry is None:
+            resp = bot_get(API_BASE_URL + '/guilds/{}'.format(guild))
+            entry = [resp.status_code, project_guild(resp.json()) if resp else None]
+            if resp.status_code < 500:
+                discord_cache.set(key, entry, current_app.config['DISCORD_CACHE_TTL'])
+        status, data = entry
+        if data is not None:
+            *fields, admin_roles = data
+            data = Guild(*fields, admin_roles=tuple(admin_roles))
+        return status, data
+    return request_memo(key, load, refresh)
 
 
 def get_guild(guild):
     '''
-    Gets a guild object
+    Gets the Guild for a guild ID
     '''
-    resp = bot_get(API_BASE_URL + '/guilds/{}'.format(guild))
-    if not resp:
-        abort(resp.status_code)
-    return resp.json()
+    status, guild = cached_guild(guild)
+    if guild is None:
+        abort(status)
+    return guild
 
 
 def user_is_admin(guild, user):
     '''
     Returns whether the user is an admin in the given guild
-    Guild may be the guild object or the guild's ID
+    Guild may be a Guild or the guild's ID
     User may be the member object or their ID
     '''
-    if isinstance(guild, str):
+    if not isinstance(guild, Guild):
         guild = get_guild(guild)
-    owner_id = guild.get('owner_id', 'no owner')
     if isinstance(user, str):
-        if owner_id == user:
+        if guild.owner_id == user:
             return True
-        user = get_user(guild['id'], user)
-    elif owner_id == user.get('user', user).get('id', 'no id'):
+        resp = user_in_guild(guild.id, user)
+        if not resp:
+            return False
+        user = resp.json()
+    elif guild.owner_id == user.get('user', user).get('id'):
         return True
-    roles = {role['id']: role for role in guild.get('roles', [])}
-    for role in user.get('roles', []):
-        if roles.get(role, {}).get('permissions', 0) & 0x00000008:
-            return True
-    return False
+    return any(role in guild.admin_roles for role in user.get('roles', []))
 
 
 def bot_in_guild(guild):
@@ -112,5 +294,5 @@ def bot_in_guild(guild):
     Returns whether the bot is in the given guild
     The guild should be a dict as returned by discord Guild resources
     '''
-    guild = bot_get(API_BASE_URL + '/guilds/{}'.format(guild.get('id')))
-    return bool(guild)
+    status, guild = cached_guild(guild.get('id'))
+    return guild is not None
@@ -0,0 +1,204 @@
+import os
+import time
+import heapq
+import threading
+
+from flask import request, session
+
+from . import util
+from .cache import discord_cache
+
+
+class CacheWarmer:
+    '''
+    Refreshes cached Discord data for recently active users and servers
+    before it expires, so interactive requests find it warm
+
+    Jobs are kept in a heap ordered by when their data is due to expire,
+    so the entries closest to expiring are refreshed first
+    Entries that another worker has already refreshed in the shared cache are skipped
+    Users and servers that haven't been seen for CACHE_WARMER_ACTIVE seconds are dropped,
+    as are guilds Discord reports the bot is not in, which are skipped for as long
+    Guilds that fail for other reasons, such as a Discord outage, are retried later
+
+    CACHE_WARMER_RATE limits the Discord calls per second of each worker,
+    so one worker can keep about RATE * DISCORD_CACHE_TTL * CACHE_WARMER_AHEAD entries warm
+    (225 with the defaults); beyond that the queue falls behind and a warning is logged
+
+    Jobs are tuples of one of the forms:
+        ('user', token key)         identity of the token's owner
+        ('guilds', token key)       guild list of the token's owner
+        ('guild', guild ID)         compact guild, also used for bot membership
+        ('member', guild ID, user ID)
+    '''
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.queue = []  # heap of (due, job)
+        self.active = {}  # job -> time its user or server was last seen
+        self.tokens = {}  # token key -> token
+        self.absent = {}  # guild ID -> time the bot was found not to be in it
+        self.warned = 0
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_WARMER', True)
+        app.config.setdefault('CACHE_WARMER_RATE', 5)
+        app.config.setdefault('CACHE_WARMER_ACTIVE', 15 * 60)
+        # refresh when this fraction of DISCORD_CACHE_TTL has passed
+        app.config.setdefault('CACHE_WARMER_AHEAD', 0.75)
+        self.app = app
+
+    def start(self):
+        # threads don't survive a fork, so each worker starts its own
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self.run, name='cache-warmer', daemon=True)
+            thread.start()
+
+    def touch(self, job, seen=None):
+        '''
+        Marks a job's user or server as active and schedules the job if it isn't already
+        '''
+        if not self.app.config['CACHE_WARMER']:
+            return
+        seen = time.time() if seen is None else seen
+        if job[0] == 'guild' and seen - self.absent.get(job[1], 0) < self.app.config['CACHE_WARMER_ACTIVE']:
+            return
+        with self.lock:
+            if job not in self.active:
+                heapq.heappush(self.queue, (seen, job))
+            self.active[job] = max(seen, self.active.get(job, 0))
+        self.start()
+
+    def touch_request(self):
+        '''
+        Records the activity of the current request's session
+        '''
+        token = session.get('oauth2_token')
+        if not token:
+            return
+        key = util.token_key(token)
+        self.tokens[key] = token
+        self.touch(('user', key))
+        self.touch(('guilds', key))
+        server_id = (request.view_args or {}).get('server_id')
+        if server_id is not None:
+            self.touch(('guild', str(server_id)))
+            if 'user_id' in session:
+                self.touch(('member', str(server_id), session['user_id']))
+
+    def drop(self, job):
+        with self.lock:
+            self.active.pop(job, None)
+        if job[0] == 'user':
+            self.tokens.pop(job[1], None)
+
+    def next_job(self):
+        '''
+        Pops the job that is closest to expiring if it is due
+        '''
+        now = time.time()
+        active = self.app.config['CACHE_WARMER_ACTIVE']
+        with self.lock:
+            if self.absent:
+                # guilds are only skipped for CACHE_WARMER_ACTIVE seconds
+                self.absent = {guild: since for guild, since in self.absent.items() if now - since < active}
+            while self.queue and self.queue[0][0] <= now:
+                due, job = heapq.heappop(self.queue)
+                if job not in self.active:
+                    continue
+                if now - self.active[job] > active:
+                    del self.active[job]
+                    if job[0] == 'user':
+                        self.tokens.pop(job[1], None)
+                    continue
+                self.check_behind(now - due)
+                return job
+        return None
+
+    def check_behind(self, late):
+        # the job's entry expired before it could be refreshed
+        ttl = self.app.config['DISCORD_CACHE_TTL']
+        if late > ttl * (1 - self.app.config['CACHE_WARMER_AHEAD']) and time.time() - self.warned > 60:
+            self.warned = time.time()
+            self.app.logger.warning(
+                'Cache warmer is %.0fs behind with %d jobs, consider raising CACHE_WARMER_RATE',
+                late, len(self.active))
+
+    def due(self, expires):
+        '''
+        When an entry expiring at the given time should be refreshed
+        '''
+        ttl = self.app.config['DISCORD_CACHE_TTL']
+        return expires - ttl * (1 - self.app.config['CACHE_WARMER_AHEAD'])
+
+    def cache_key(self, job):
+        kind, *args = job
+        if kind == 'member':
+            return 'bot:/guilds/{}/members/{}'.format(*args)
+        return '{}:{}'.format(kind, args[0])
+
+    def reschedule(self, job, due=None):
+        if due is None:
+            ttl = self.app.config['DISCORD_CACHE_TTL']
+            due = time.time() + ttl * self.app.config['CACHE_WARMER_AHEAD']
+        with self.lock:
+            if job in self.active:
+                heapq.heappush(self.queue, (due, job))
+
+    def warm(self, job):
+        '''
+        Refreshes the data for a job
+        Returns whether Discord was called
+        '''
+        kind, *args = job
+        if kind in ('user', 'guilds'):
+            token = self.tokens.get(args[0])
+            if token is None:
+                self.drop(job)
+                return False
+            user, discord = util.get_user(token, refresh=(kind == 'user'))
+            if user is None:
+                # the token is no longer valid
+                self.drop(job)
+                self.tokens.pop(args[0], None)
+                return True
+            if kind == 'guilds':
+                seen = self.active.get(job)
+                for guild in util.get_user_guilds(discord, refresh=True):
+                    self.touch(('guild', guild['id']), seen)
+        elif kind == 'guild':
+            status, guild = util.cached_guild(args[0], refresh=True)
+            if status in (403, 404):
+                # the bot isn't in the guild, so there is nothing to keep warm
+                self.absent[args[0]] = time.time()
+                self.drop(job)
+        elif kind == 'member':
+            util.user_in_guild(*args, refresh=True)
+        return True
+
+    def run(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                time.sleep(1)
+                continue
+            # another worker may have refreshed the shared entry already
+            expires = discord_cache.expires(self.cache_key(job))
+            if expires is not None and self.due(expires) > time.time():
+                self.reschedule(job, self.due(expires))
+                continue
+            with self.app.app_context():
+                try:
+                    called = self.warm(job)
+                except Exception:
+                    called = True
+                    self.app.logger.exception('Failed to warm %s', job[0])
+            self.reschedule(job)
+            if called:
+                time.sleep(1 / self.app.config['CACHE_WARMER_RATE'])
+
+
+warmer = CacheWarmer()
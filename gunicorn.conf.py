@@ -0,0 +1,35 @@
+# gunicorn settings for the cooperative (gevent) serving mode
+# run with: gunicorn --config gunicorn.conf.py application:application
+#
+# Almost all of a request's time is spent waiting on Discord,
+# so each worker serves many requests at once on green threads
+import os
+import tempfile
+import multiprocessing
+
+# the app reads its database from DB, Heroku provides DATABASE_URL
+if 'DATABASE_URL' in os.environ:
+    os.environ.setdefault('DB', os.environ['DATABASE_URL'])
+
+# share cached Discord data between the workers on this host
+os.environ.setdefault('DISCORD_CACHE', os.path.join(tempfile.gettempdir(), 'dicebot-discord-cache.db'))
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '5000'))
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+# in-flight requests per worker
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 200))
+# 429 back-off can hold a request for a while
+timeout = 60
+
+
+def post_fork(server, worker):
+    # make psycopg2 yield to other green threads while waiting on the database
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def worker_exit(server, worker):
+    # write increments that were accepted but not yet flushed
+    from dicebot_web.coalesce import coalescer
+    coalescer.flush_all()
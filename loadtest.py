@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+'''
+Load test that replays simulated user sessions against the app
+
+Each session logs in through a fake OAuth callback, loads the homepage,
+opens one of the user's character sheets and sends a burst of resource PATCHes
+Discord is replaced by a local fake server, which counts the calls the app makes
+
+Sessions are run at each concurrency level in turn with a cold Discord cache,
+and throughput, latency percentiles, error rate and Discord calls per request are reported
+Runs are reproducible for a given seed
+
+By default the app runs in this process behind Flask's test client, with each session on an OS thread,
+which measures the app's own work but not the gevent serving mode used in production
+With --gunicorn the app is served by gunicorn.conf.py's gevent workers instead
+and sessions talk to them over HTTP
+
+usage: python loadtest.py --concurrency 1 8 32 --sessions 200 --seed 1
+       python loadtest.py --gunicorn --workers 2 --db postgresql://...
+'''
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+# IDs are in a range that won't collide with real Discord snowflakes
+USER_BASE = 100000000000000000
+SERVER_BASE = 900000000000000000
+
+
+class ThreadingHTTPServer (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeDiscord:
+    '''
+    Serves the parts of the Discord API used by the app
+    Access tokens are "token-<user ID>" and the OAuth code is the user ID
+    Every user is a member of every server, every tenth user is an admin
+    '''
+    def __init__(self, users, servers, latency):
+        self.users = users
+        self.servers = servers
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+    def user(self, user_id):
+        return {'id': user_id, 'username': 'user{}'.format(user_id), 'discriminator': '0001', 'avatar': None}
+
+    def guild(self, server_id):
+        return {
+            'id': server_id,
+            'name': 'server {}'.format(server_id),
+            'icon': None,
+            'owner_id': self.users[0],
+            'roles': [
+                {'id': server_id, 'name': '@everyone', 'permissions': 0},
+                {'id': str(int(server_id) + 1), 'name': 'admin', 'permissions': 0x00000008},
+            ],
+            'emojis': [],
+            'features': [],
+        }
+
+    def member(self, server_id, user_id):
+        admin = self.users.index(user_id) % 10 == 0
+        return {'user': self.user(user_id), 'nick': None, 'roles': [str(int(server_id) + 1)] if admin else []}
+
+    def route(self, method, path, headers, body):
+        '''
+        Returns the status code and JSON body for a request
+        '''
+        auth = headers.get('Authorization', '')
+        token_user = auth[len('Bearer token-'):] if auth.startswith('Bearer token-') else None
+        if method == 'POST' and path == '/api/oauth2/token':
+            code = parse_qs(body).get('code', [''])[0]
+            return 200, {
+                'access_token': 'token-' + code,
+                'token_type': 'Bearer',
+                'expires_in': 604800,
+                'refresh_token': 'refresh-' + code,
+                'scope': 'identify guilds',
+            }
+        if method != 'GET':
+            return 405, {'message': 'method not allowed'}
+        if path == '/api/users/@me':
+            if token_user not in self.users:
+                return 401, {'message': '401: Unauthorized'}
+            return 200, self.user(token_user)
+        if path == '/api/users/@me/guilds':
+            if token_user not in self.users:
+                return 401, {'message': '401: Unauthorized'}
+            return 200, [{'id': id, 'name': 'server {}'.format(id), 'icon': None} for id in self.servers]
+        match = re.fullmatch(r'/api/users/(\d+)', path)
+        if match:
+            if match.group(1) not in self.users:
+                return 404, {'message': 'Unknown User'}
+            return 200, self.user(match.group(1))
+        match = re.fullmatch(r'/api/guilds/(\d+)', path)
+        if match:
+            if match.group(1) not in self.servers:
+                return 403, {'message': 'Missing Access'}
+            return 200, self.guild(match.group(1))
+        match = re.fullmatch(r'/api/guilds/(\d+)/members/(\d+)', path)
+        if match:
+            server_id, user_id = match.groups()
+            if server_id not in self.servers:
+                return 403, {'message': 'Missing Access'}
+            if user_id not in self.users:
+                return 404, {'message': 'Unknown Member'}
+            return 200, self.member(server_id, user_id)
+        return 404, {'message': '404: Not Found'}
+
+    def handler(self):
+        fake = self
+
+        class Handler (BaseHTTPRequestHandler):
+            def respond(self, method):
+                path = urlparse(self.path).path
+                with fake.lock:
+                    fake.calls[re.sub(r'/\d+', '/<id>', path)] += 1
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, data = fake.route(method, path, self.headers, body)
+                data = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def configure(discord_url, warmer):
+    '''
+    Points the app at the fake Discord and returns it
+    '''
+    import dicebot_web
+    from dicebot_web import app, util
+
+    util.API_BASE_URL = discord_url + '/api'
+    util.TOKEN_URL = dicebot_web.TOKEN_URL = discord_url + '/api/oauth2/token'
+    util.AUTHORIZATION_BASE_URL = dicebot_web.AUTHORIZATION_BASE_URL = discord_url + '/api/oauth2/authorize'
+    app.config.update({
+        'token': 'bot-token',
+        'discord_client_id': 'loadtest',
+        'discord_client_secret': 'loadtest',
+        'CACHE_WARMER': warmer,
+    })
+    app.secret_key = 'loadtest'
+    # rendered with the old client ID during import
+    dicebot_web.error_pages.clear()
+    return app
+
+
+# entry point for the workers started with --gunicorn
+if 'LOADTEST_DISCORD' in os.environ:
+    application = configure(os.environ['LOADTEST_DISCORD'], os.environ.get('LOADTEST_WARMER') == '1')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(port, workers, discord_url, warmer):
+    '''
+    Serves the app with the production gunicorn settings and waits until it answers
+    '''
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers), LOADTEST_DISCORD=discord_url)
+    if warmer:
+        env['LOADTEST_WARMER'] = '1'
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'loadtest:application'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    url = 'http://127.0.0.1:{}'.format(port)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with status {}'.format(process.returncode))
+        try:
+            requests.get(url + '/login/', allow_redirects=False, timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start within 30 seconds')
+
+
+class HTTPClient:
+    '''
+    Sends requests to a running server, keeping cookies like the test client does
+    '''
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+
+    def open(self, path, method='GET', data=None):
+        return self.session.request(method, self.url + path, data=data, allow_redirects=False, timeout=120)
+
+
+def seed(db, m, users, servers):
+    '''
+    Gives every user a character with some resources on every server
+    Returns {(server ID, user ID): (character ID, [resource IDs])}
+    '''
+    characters = []
+    for server_id in servers:
+        for user_id in users:
+            # reuse characters left by an earlier run against the same database
+            character = db.session.query(m.Character).filter_by(server=server_id, user=user_id).one_or_none()
+            if character is not None:
+                characters.append(character)
+                continue
+            character = m.Character(name='character {}'.format(user_id), user=user_id, server=server_id)
+            character.resources.append(m.Resource(name='hp', max=30, current=30, recover=m.Rest.long))
+            character.resources.append(m.Resource(name='temp hp', max=0, current=0, recover=m.Rest.long))
+            character.resources.append(m.Resource(name='spell slots', max=4, current=4, recover=m.Rest.long))
+            character.variables.append(m.Variable(name='str', value=2))
+            db.session.add(character)
+            characters.append(character)
+    db.session.commit()
+    return {
+        (character.server, character.user): (character.id, [resource.id for resource in character.resources])
+        for character in characters
+    }
+
+
+class Session:
+    '''
+    One simulated user visit, recording the latency and status of each request
+    '''
+    def __init__(self, client, rng, users, servers, characters, patches):
+        self.client = client
+        self.rng = rng
+        self.user_id = rng.choice(users)
+        self.server_id = rng.choice(servers)
+        self.character_id, self.resources = characters[(self.server_id, self.user_id)]
+        self.patches = patches
+        self.results = []
+
+    def request(self, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.client.open(url, method=method, **kwargs)
+            status = response.status_code
+        except Exception:
+            response, status = None, 599
+        self.results.append((time.perf_counter() - start, status))
+        return response
+
+    def run(self):
+        response = self.request('GET', '/login/')
+        if response is None or 'Location' not in response.headers:
+            return self.results
+        state = parse_qs(urlparse(response.headers['Location']).query)['state'][0]
+        self.request('GET', '/callback?code={}&state={}'.format(self.user_id, state))
+        self.request('GET', '/')
+        self.request('GET', '/api/user/@me/servers')
+        self.request('GET', '/api/server/{}/characters/@me'.format(self.server_id))
+        self.request('GET', '/character?character={}'.format(self.character_id))
+        self.request('GET', '/api/characters/{}'.format(self.character_id))
+        self.request('GET', '/api/user/@me?server={}'.format(self.server_id))
+        self.request('GET', '/api/server/{}'.format(self.server_id))
+        self.request('GET', '/api/characters/{}/resources'.format(self.character_id))
+        for i in range(self.patches if self.resources else 0):
+            resource_id = self.rng.choice(self.resources)
+            self.request(
+                'PATCH', '/api/characters/{}/resources/{}'.format(self.character_id, resource_id),
+                data={'current': self.rng.randint(0, 30)})
+        return self.results
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays simulated sessions against the app')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64],
+                        help='Numbers of simultaneous sessions to test')
+    parser.add_argument('--sessions', type=int, default=100, help='Sessions to run at each concurrency level')
+    parser.add_argument('--users', type=int, default=50, help='Number of simulated users')
+    parser.add_argument('--servers', type=int, default=5, help='Number of simulated servers')
+    parser.add_argument('--patches', type=int, default=10, help='Resource PATCHes per session')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds the fake Discord takes per call')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the simulated sessions')
+    parser.add_argument('--db', help='Database URL, defaults to a temporary SQLite file')
+    parser.add_argument('--warmer', action='store_true', help='Leave the background cache warmer on')
+    parser.add_argument('--gunicorn', action='store_true', help='Serve the app with gunicorn and gevent workers')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    args = parser.parse_args()
+
+    users = [str(USER_BASE + i) for i in range(args.users)]
+    servers = [str(SERVER_BASE + i * 10) for i in range(args.servers)]
+
+    tempdir = None
+    if args.db is None:
+        tempdir = tempfile.TemporaryDirectory()
+        args.db = 'sqlite:///' + os.path.join(tempdir.name, 'loadtest.db')
+    # the app connects to the database when it is imported
+    os.environ['DB'] = args.db
+    if args.gunicorn:
+        # clearing this process's cache then clears the one shared by the workers
+        cache_dir = tempfile.TemporaryDirectory()
+        os.environ['DISCORD_CACHE'] = os.path.join(cache_dir.name, 'discord-cache.db')
+
+    discord = FakeDiscord(users, servers, args.latency)
+    discord.start()
+    app = configure(discord.url, args.warmer)
+    from dicebot_web.cache import discord_cache
+    from dicebot_web.database import db, m
+
+    with app.app_context():
+        characters = seed(db, m, users, servers)
+
+    server = None
+    if args.gunicorn:
+        server, url = start_gunicorn(free_port(), args.workers, discord.url, args.warmer)
+
+    print('{:>11} {:>8} {:>9} {:>8} {:>8} {:>8} {:>7} {:>8} {:>9}'.format(
+        'concurrency', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'discord', 'calls/req'))
+    try:
+        for concurrency in args.concurrency:
+            discord_cache.clear()
+            discord.reset()
+            sessions = [
+                Session(
+                    HTTPClient(url) if server else app.test_client(),
+                    random.Random('{}-{}'.format(args.seed, i)), users, servers, characters, args.patches)
+                for i in range(args.sessions)
+            ]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                results = [result for session in pool.map(Session.run, sessions) for result in session]
+            elapsed = time.perf_counter() - start
+
+            latencies = sorted(latency for latency, status in results)
+            errors = sum(1 for latency, status in results if status >= 400)
+            calls = sum(discord.calls.values())
+            print('{:>11} {:>8} {:>9.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>6.1%} {:>8} {:>9.2f}'.format(
+                concurrency,
+                len(results),
+                len(results) / elapsed,
+                percentile(latencies, 0.50) * 1000,
+                percentile(latencies, 0.95) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                errors / len(results),
+                calls,
+                calls / len(results),
+            ))
+        print()
+        print('Discord calls by endpoint at the last level:')
+        for path, count in discord.calls.most_common():
+            print('{:>8} {}'.format(count, path))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            cache_dir.cleanup()
+        if tempdir is not None:
+            tempdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()